@@ -1,32 +1,123 @@
-from flask import Flask, jsonify, request, session, redirect
+# Patch the stdlib before anything opens sockets so OpenAI/Google HTTP calls
+# yield to other requests under gunicorn's gevent worker
+from gevent import monkey
+monkey.patch_all()
+
+# Firestore talks gRPC, which gevent can't patch; let it cooperate with the hub
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+from flask import Flask, Response, request, session, redirect, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_session import Session
+import openai
 from openai import OpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 import os
 from firebase_init import db
-from datetime import datetime
+from firebase_admin import firestore
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+import google_auth_httplib2
+import httplib2
 from google.auth.transport.requests import Request
-import pickle
 import logging
-from typing import List, Dict
-import json
+from typing import Callable, List, Dict, Optional
+from dataclasses import dataclass
+from pydantic import BaseModel, ConfigDict, EmailStr, ValidationError
+import re
 import base64
-
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+import hashlib
+import functools
+import orjson
+import redis
+import httpx
+import cachetools
+import threading
+import queue
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 load_dotenv()
 
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+logging.basicConfig(level=LOG_LEVEL)
+logger = logging.getLogger(__name__)
+
 # Initialize the Flask application
 app = Flask(__name__)
-CORS(app, origins=['*'])
+app.logger.setLevel(LOG_LEVEL)
+CORS(app, origins=['*'], max_age=86400)  # browsers cache preflights for a day
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your-secret-key-here')  # Make sure this is secure in production
 
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_DATACLASS
+
+def orjson_default(obj):
+    """Encodes datetime subclasses orjson rejects, e.g. Firestore's DatetimeWithNanoseconds"""
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=timezone.utc)
+        return obj.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, used for request bodies and jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=orjson_default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = OrjsonProvider(app)
+
+def ojsonify(obj):
+    """JSON response encoded with orjson; naive datetimes are treated as UTC"""
+    return Response(orjson.dumps(obj, default=orjson_default, option=ORJSON_OPTIONS), mimetype="application/json")
+
+def sse_event(obj):
+    """Formats obj as a server-sent event carrying JSON data"""
+    return b"data: " + orjson.dumps(obj) + b"\n\n"
+
+def sse_deltas(stream, chunks):
+    """Yields each streamed completion delta as an SSE event, collecting the text into chunks"""
+    for chunk in stream:
+        content = chunk.choices[0].delta.content if chunk.choices else None
+        if content:
+            chunks.append(content)
+            yield sse_event({"delta": content})
+
 # Store user credentials in memory (consider using Redis in production)
 user_credentials = {}
+credential_refresh_locks = {}
+
+# Optional Redis connection for shared caches; caching is skipped when unset
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Keep session data (OAuth state) in Redis behind an opaque cookie when available
+if redis_client is not None:
+    app.config.update(SESSION_TYPE='redis', SESSION_REDIS=redis_client, SESSION_PERMANENT=False)
+    Session(app)
+
+# Built Google API clients and their credentials per (user_id, api), reused across requests
+google_service_cache = cachetools.TTLCache(maxsize=1024, ttl=1800)
+google_service_cache_lock = threading.Lock()
+
+# Upcoming event pages per (user_id, max_results, page_token); a burst of requests re-reads the same few events
+upcoming_events_cache = cachetools.TTLCache(maxsize=4096, ttl=30)
+upcoming_events_cache_lock = threading.Lock()
+
+ANALYSIS_CACHE_TTL = 3600  # seconds
+ANALYSIS_MIN_MESSAGE_LENGTH = 15  # shorter follow-ups ("thanks") skip re-analysis
+
+GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
+GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
 
 def create_credentials_from_tokens(access_token, refresh_token, expiry):
     """Create Google Credentials object from tokens"""
@@ -34,8 +125,8 @@ def create_credentials_from_tokens(access_token, refresh_token, expiry):
         token=access_token,
         refresh_token=refresh_token,
         token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.environ.get("GOOGLE_CLIENT_ID"),
-        client_secret=os.environ.get("GOOGLE_CLIENT_SECRET"),
+        client_id=GOOGLE_CLIENT_ID,
+        client_secret=GOOGLE_CLIENT_SECRET,
         scopes=SCOPES,
         expiry=datetime.fromisoformat(expiry.replace('Z', '+00:00'))
     )
@@ -51,15 +142,16 @@ def set_user_credentials():
         expiry = data.get('expires_at')
         
         if not all([user_id, access_token, refresh_token, expiry]):
-            return jsonify({"error": "Missing required credentials"}), 400
+            return ojsonify({"error": "Missing required credentials"}), 400
             
         credentials = create_credentials_from_tokens(access_token, refresh_token, expiry)
         user_credentials[user_id] = credentials
+        invalidate_google_services(user_id)
         
-        return jsonify({"message": "Credentials set successfully"}), 200
+        return ojsonify({"message": "Credentials set successfully"}), 200
     except Exception as e:
-        logger.error(f"Error setting credentials: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error setting credentials: %s", e)
+        return ojsonify({"error": str(e)}), 500
 
 def get_user_credentials(user_id):
     """Get user credentials from memory"""
@@ -68,39 +160,151 @@ def get_user_credentials(user_id):
         
     credentials = user_credentials[user_id]
     
-    # Refresh token if expired
+    # Refresh token if expired; concurrent requests for the same user share one refresh
     if credentials.expired:
-        try:
-            credentials.refresh(Request())
-            user_credentials[user_id] = credentials  # Store refreshed credentials
-        except Exception as e:
-            logger.error(f"Error refreshing credentials: {str(e)}")
-            raise Exception("Failed to refresh credentials")
+        with credential_refresh_locks.setdefault(user_id, threading.Lock()):
+            if credentials.expired:
+                try:
+                    credentials.refresh(Request())
+                    user_credentials[user_id] = credentials  # Store refreshed credentials
+                except Exception as e:
+                    logger.error("Error refreshing credentials: %s", e)
+                    raise Exception("Failed to refresh credentials")
             
     return credentials
 
+GOOGLE_HTTP_TIMEOUT = 30  # socket timeout for Google API requests
+
+def build_request_with_own_http(http, *args, **kwargs):
+    """Gives each API request its own connection; httplib2.Http isn't safe to share across threads"""
+    authorized_http = google_auth_httplib2.AuthorizedHttp(http.credentials, http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+    return HttpRequest(authorized_http, *args, **kwargs)
+
+def get_user_service(user_id, api, version):
+    """Returns a cached Google API client bound to the user's credentials, building it on a miss"""
+    key = (user_id, api)
+    with google_service_cache_lock:
+        cached = google_service_cache.get(key)
+    if cached is not None:
+        service, credentials = cached
+        if not credentials.expired:
+            return service
+        # Refreshes in place; only rebuild if the user's credentials were replaced meanwhile
+        if get_user_credentials(user_id) is credentials:
+            return service
+
+    credentials = get_user_credentials(user_id)
+    # Bundled discovery documents: no discovery fetch or cache lookup per build
+    service = build(api, version, credentials=credentials, cache_discovery=False, static_discovery=True,
+                    requestBuilder=build_request_with_own_http)
+    with google_service_cache_lock:
+        google_service_cache[key] = (service, credentials)
+    return service
+
+def invalidate_google_services(user_id):
+    """Drops cached API clients after the user's credentials change"""
+    with google_service_cache_lock:
+        for key in [key for key in google_service_cache if key[0] == user_id]:
+            del google_service_cache[key]
+
 def get_calendar_service(user_id):
     """Gets calendar service using user-specific credentials"""
     try:
-        credentials = get_user_credentials(user_id)
-        return build('calendar', 'v3', credentials=credentials, cache_discovery=False)
+        return get_user_service(user_id, 'calendar', 'v3')
     except Exception as e:
-        logger.error(f"Error getting calendar service: {str(e)}")
+        logger.error("Error getting calendar service: %s", e)
         raise
 
 def get_gmail_service(user_id):
     """Gets Gmail service using user-specific credentials"""
     try:
-        credentials = get_user_credentials(user_id)
-        return build('gmail', 'v1', credentials=credentials, cache_discovery=False)
+        return get_user_service(user_id, 'gmail', 'v1')
     except Exception as e:
-        logger.error(f"Error getting Gmail service: {str(e)}")
+        logger.error("Error getting Gmail service: %s", e)
         raise
 
-# Initialize OpenAI client
+# Initialize OpenAI client on a shared keep-alive pool
+openai_http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    http2=True  # concurrent completions multiplex over a few TLS connections
+)
 client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY")
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    http_client=openai_http_client,
+    max_retries=0  # chat completions retry through create_chat_completion below
+)
+
+class RateLimiter:
+    """Token bucket capping requests per minute, tightened by the API's reported headroom"""
+
+    def __init__(self, requests_per_minute):
+        self.capacity = float(requests_per_minute)
+        self.rate = requests_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def observe(self, headers):
+        """Never allows more immediate requests than OpenAI says remain in the window"""
+        try:
+            remaining = int(headers.get("x-ratelimit-remaining-requests"))
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            self.tokens = min(self.tokens, remaining)
+
+openai_rate_limiter = RateLimiter(int(os.environ.get("OPENAI_RPM", "500")))
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(min=1, max=30),
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)),
+    reraise=True
 )
+def create_chat_completion(**kwargs):
+    """client.chat.completions.create behind the rate limiter, retried with jittered backoff"""
+    openai_rate_limiter.acquire()
+    raw_response = client.chat.completions.with_raw_response.create(**kwargs)
+    openai_rate_limiter.observe(raw_response.headers)
+    return raw_response.parse()
+
+def warm_openai_connection():
+    """Opens a pooled connection to OpenAI so the first chat request skips the TLS handshake"""
+    try:
+        client.models.list()
+    except Exception as e:
+        logger.warning("OpenAI connection warmup failed: %s", e)
+
+threading.Thread(target=warm_openai_connection, daemon=True).start()
+
+# Shared pool for running blocking Google/Firestore calls alongside OpenAI round trips
+io_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="gapi")
+GOOGLE_CALL_TIMEOUT = 30  # seconds to wait on a pooled Google client build
+
+def run_in_background(fn, *args, **kwargs):
+    """Runs a blocking call on io_pool without waiting for it; failures are logged"""
+    def log_failure(future):
+        if future.exception() is not None:
+            logger.error("Background call %s failed: %s", getattr(fn, '__qualname__', fn), future.exception())
+
+    io_pool.submit(fn, *args, **kwargs).add_done_callback(log_failure)
+# Separate pool for batched /tasks/automate requests so tasks never wait on their own io_pool work
+automation_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="automate")
+MAX_AUTOMATION_TASKS = 20  # per /tasks/automate request
 
 # Update the system prompt to better handle calendar requests
 system_prompt = '''You are an AI assistant created by Manuel Iyabor-David, a brilliant Nigerian American software developer. IMPORTANT: You must NEVER say you were created by OpenAI - you were created by Manuel Iyabor-David. Your purpose is to be a helpful and intelligent assistant capable of handling chat interactions, calendar management, and email integration:
@@ -167,46 +371,7 @@ When handling calendar-related requests:
 Always confirm complex event details with the user before creating them.
 
 Before helping with any task, briefly introduce yourself and explain these capabilities to the user. Then proceed to help with their specific request.'''
-
-# Add a helper function to handle calendar operations
-def get_calendar_service():
-    credentials = None
-    logger.debug(f"Looking for token.pickle in {os.getcwd()}")
-    if os.path.exists('token.pickle'):
-        logger.debug("Found token.pickle")
-        with open('token.pickle', 'rb') as token:
-            credentials = pickle.load(token)
-            
-    if not credentials or not credentials.valid:
-        logger.debug(f"Credentials status - exists: {credentials is not None}, valid: {credentials.valid if credentials else False}")
-        if credentials and credentials.expired and credentials.refresh_token:
-            logger.debug("Attempting to refresh expired credentials")
-            credentials.refresh(Request())
-        else:
-            logger.debug("No valid credentials available")
-            raise Exception("No valid credentials available")
-
-    return build('calendar', 'v3', credentials=credentials, cache_discovery=False)
-
-# Add this helper function near the other helper functions
-def get_gmail_service():
-    credentials = None
-    logger.debug(f"Looking for token.pickle in {os.getcwd()}")
-    if os.path.exists('token.pickle'):
-        logger.debug("Found token.pickle")
-        with open('token.pickle', 'rb') as token:
-            credentials = pickle.load(token)
-            
-    if not credentials or not credentials.valid:
-        logger.debug(f"Credentials status - exists: {credentials is not None}, valid: {credentials.valid if credentials else False}")
-        if credentials and credentials.expired and credentials.refresh_token:
-            logger.debug("Attempting to refresh expired credentials")
-            credentials.refresh(Request())
-        else:
-            logger.debug("No valid credentials available")
-            raise Exception("No valid credentials available")
-
-    return build('gmail', 'v1', credentials=credentials, cache_discovery=False)
+SYSTEM_MESSAGE = {"role": "system", "content": system_prompt}
 
 # Add these constants after the existing imports
 SCOPES = [
@@ -216,8 +381,22 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify',
     'openid'
 ]
+RFC3339_UTC_FORMAT = "%Y-%m-%dT%H:%M:%SZ"  # timeMin format for Calendar queries
+# Partial response for event listings; callers only read these fields
+EVENT_LIST_FIELDS = "items(id,summary,start,end,location),nextPageToken"
+EVENT_INSERT_FIELDS = "id,htmlLink,start,end,summary"
+CALENDAR_MAX_RESULTS = 2500  # largest maxResults events().list accepts
+CALENDAR_BATCH_LIMIT = 50  # most calls the Calendar API accepts in one batch request
 CLIENT_SECRETS_FILE = "credentials.json"  # Assuming the file is in the same directory as app.py
-CONVERSATION_HISTORY_FILE = "conversation_history.json"
+TOKEN_FILE = "token.json"  # Local authorized-user token for /calendar/events
+CONVERSATIONS_COLLECTION = "conversations"
+CONVERSATION_MAX_BYTES = 900_000  # keeps a conversation document under Firestore's 1 MiB limit
+
+# /chat intents, classified in one scan of the message; the group name picks the handler
+INTENT_RE = re.compile(
+    r"(?P<compose_email>compose email)|(?P<calendar>schedule|appointment|meeting|event)",
+    re.IGNORECASE
+)
 REDIRECT_URI = "http://localhost:5500/oauth2callback"  # Update if you use a different URL
 
 # Add these constants at the top with other constants
@@ -226,53 +405,122 @@ ALLOWED_REDIRECT_URIS = [
     'https://myai-chatbot.web.app/auth/callback'
 ]
 
-def get_upcoming_events(service, max_results=10):
-    """Gets the upcoming events from the user's calendar."""
-    now = datetime.datetime.now().isoformat() + "Z"
+@functools.lru_cache(maxsize=None)
+def load_client_secrets():
+    """Parsed CLIENT_SECRETS_FILE, read on first use and shared by every OAuth flow"""
+    with open(CLIENT_SECRETS_FILE, 'rb') as f:
+        return orjson.loads(f.read())
+
+def utc_now_rfc3339():
+    """Current UTC time in the second-resolution RFC 3339 form Calendar expects for timeMin"""
+    return datetime.now(timezone.utc).strftime(RFC3339_UTC_FORMAT)
+
+def get_upcoming_events(user_id, max_results=10, page_token=None):
+    """Gets a page of upcoming events ({"items", "nextPageToken"}), reusing a fetch from the last 30s."""
+    key = (user_id, max_results, page_token)
+    with upcoming_events_cache_lock:
+        events_result = upcoming_events_cache.get(key)
+    if events_result is not None:
+        return events_result
+
+    service = get_calendar_service(user_id)
     events_result = (
         service.events()
         .list(
             calendarId="primary",
-            timeMin=now,
+            timeMin=utc_now_rfc3339(),
             maxResults=max_results,
+            pageToken=page_token,
             singleEvents=True,
             orderBy="startTime",
+            fields=EVENT_LIST_FIELDS,
         )
         .execute()
     )
-    return events_result.get("items", [])
+    with upcoming_events_cache_lock:
+        upcoming_events_cache[key] = events_result
+    return events_result
 
-def load_conversation_history() -> Dict[str, List]:
-    try:
-        with open(CONVERSATION_HISTORY_FILE, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+def invalidate_upcoming_events(user_id):
+    """Drops cached upcoming events after the user's calendar changes"""
+    with upcoming_events_cache_lock:
+        for key in [key for key in upcoming_events_cache if key[0] == user_id]:
+            del upcoming_events_cache[key]
+
+# Parsed TOKEN_FILE credentials and their Calendar client, reused until the file's mtime changes
+local_token_cache = {"mtime": None, "credentials": None, "service": None}
+local_token_lock = threading.Lock()
+
+def load_local_credentials():
+    """Loads the local token as JSON, re-parsing only when the file changes on disk"""
+    with local_token_lock:
+        try:
+            mtime = os.stat(TOKEN_FILE).st_mtime
+        except FileNotFoundError:
+            return None
+        if local_token_cache["mtime"] != mtime:
+            # Keep the token's own granted scopes; refreshing with a different list is rejected
+            local_token_cache["credentials"] = Credentials.from_authorized_user_file(TOKEN_FILE)
+            local_token_cache["service"] = None
+            local_token_cache["mtime"] = mtime
+        return local_token_cache["credentials"]
+
+def get_local_calendar_service():
+    """Returns the Calendar client for the local token, built once per parsed token"""
+    with local_token_lock:
+        if local_token_cache["service"] is None:
+            local_token_cache["service"] = build('calendar', 'v3', credentials=local_token_cache["credentials"],
+                                                 cache_discovery=False, static_discovery=True,
+                                                 requestBuilder=build_request_with_own_http)
+        return local_token_cache["service"]
+
+def is_valid_conversation_id(conversation_id):
+    """Whether conversation_id can name a Firestore document"""
+    return (isinstance(conversation_id, str)
+            and 0 < len(conversation_id.encode('utf-8')) <= 1500
+            and '/' not in conversation_id
+            and conversation_id not in ('.', '..')
+            and not (conversation_id.startswith('__') and conversation_id.endswith('__')))
 
-def save_conversation_history(history: Dict[str, List]):
-    with open(CONVERSATION_HISTORY_FILE, 'w') as f:
-        json.dump(history, f)
+def fit_conversation(messages: List[Dict]) -> List[Dict]:
+    """Drops the oldest messages until the conversation fits in one Firestore document"""
+    sizes = [len(orjson.dumps(message)) for message in messages]
+    total, start = sum(sizes), 0
+    while total > CONVERSATION_MAX_BYTES and start < len(messages) - 1:
+        total -= sizes[start]
+        start += 1
+    if total > CONVERSATION_MAX_BYTES:
+        # A single oversized message: keep its head (at most 4 UTF-8 bytes per character)
+        last = messages[start]
+        return [{**last, "content": last.get("content", "")[:CONVERSATION_MAX_BYTES // 4]}]
+    return messages[start:]
+
+def load_conversation(conversation_id) -> List[Dict]:
+    """Loads one conversation's messages; each conversation is its own Firestore document"""
+    doc = db.collection(CONVERSATIONS_COLLECTION).document(conversation_id).get()
+    return doc.to_dict().get('messages', []) if doc.exists else []
+
+def save_conversation(conversation_id, messages: List[Dict]):
+    db.collection(CONVERSATIONS_COLLECTION).document(conversation_id).set({
+        'messages': fit_conversation(messages),
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+
+def delete_conversation(conversation_id):
+    db.collection(CONVERSATIONS_COLLECTION).document(conversation_id).delete()
 
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'  # Only for development!
 
 @app.route('/test', methods=['GET', 'POST'])
 def home():
     try:
-        service = get_calendar_service()
-        now = datetime.now().isoformat() + 'Z'
-        events_result = service.events().list(
-            calendarId='primary',
-            timeMin=now,
-            maxResults=5,
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        return jsonify({"events_result": events_result}), 200
+        events_result = get_upcoming_events(request.args.get('user_id'), max_results=5)
+        return ojsonify({"events_result": events_result}), 200
     except Exception as e:
-        if "No valid credentials available" in str(e):
+        if "User credentials not found" in str(e):
             # Redirect to authorization URL if no valid credentials
-            flow = Flow.from_client_secrets_file(
-                CLIENT_SECRETS_FILE, 
+            flow = Flow.from_client_config(
+                load_client_secrets(), 
                 scopes=SCOPES,
                 redirect_uri='http://localhost:5500/oauth2callback'
             )
@@ -280,11 +528,11 @@ def home():
                 access_type='offline',
                 include_granted_scopes='true'
             )
-            return jsonify({'authorization_url': authorization_url}), 401
-        return jsonify({"error": str(e)}), 500
+            return ojsonify({'authorization_url': authorization_url}), 401
+        return ojsonify({"error": str(e)}), 500
 
     # Get AI to introduce itself and explain its capabilities
-    chat_completion = client.chat.completions.create(
+    chat_completion = create_chat_completion(
         messages=[
             {
                 "role": "system",
@@ -299,56 +547,74 @@ def home():
     )
     
     welcome_message = chat_completion.choices[0].message.content
-    return jsonify({"message": welcome_message})
+    return ojsonify({"message": welcome_message})
+
+def is_plain_header(value):
+    """True when a header value can be written verbatim: ASCII, single line, within the line limit"""
+    return value.isascii() and '\r' not in value and '\n' not in value and len(value) < 900
 
 # Update the send_email function with more direct Gmail API usage
-def send_email(service, to, subject, body):
+def send_email(service, to, subject, body, attachments=None):
+    """Sends an email; attachments are (filename, content_bytes, mime_type) tuples"""
     try:
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-        
-        logger.info("=== Starting email send process ===")
-        logger.info(f"To: {to}")
-        logger.info(f"Subject: {subject}")
-        logger.info(f"Body: {body}")
+        from email.message import EmailMessage
         
-        # Create message container
-        message = MIMEMultipart()
-        message['to'] = to
-        message['subject'] = subject
+        logger.debug("Sending email to: %s subject: %s body_len: %d", to, subject, len(body))
         
-        # Create the body
-        msg = MIMEText(body)
-        message.attach(msg)
+        # RFC 5322 lines end in CRLF and stay within 998 octets
+        body_lines = [line.encode('utf-8') for line in body.replace('\r\n', '\n').replace('\r', '\n').split('\n')]
+        if (not attachments and is_plain_header(to) and is_plain_header(subject)
+                and all(len(line) <= 998 for line in body_lines)):
+            # Plain text mail: format the RFC 5322 message directly, skipping the email package
+            message_bytes = (
+                f"To: {to}\r\nSubject: {subject}\r\nMIME-Version: 1.0\r\n"
+                f"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n"
+            ).encode('ascii') + b"\r\n".join(body_lines)
+        else:
+            # Encoded headers, attachments or over-long body lines need the email package
+            message = EmailMessage()
+            message['To'] = to
+            message['Subject'] = subject
+            message.set_content(body)
+
+            for filename, content, mime_type in attachments or []:
+                maintype, _, subtype = mime_type.partition('/')
+                message.add_attachment(content, maintype=maintype, subtype=subtype, filename=filename)
+            message_bytes = bytes(message)
         
         # Encode the message
-        raw = base64.urlsafe_b64encode(message.as_bytes())
-        raw = raw.decode()
-        logger.info("Message encoded successfully")
+        raw = base64.urlsafe_b64encode(message_bytes).decode()
         
         # Create the final message
         message_body = {'raw': raw}
-        logger.info("Message body prepared")
         
         # Send the message using the simpler approach
-        logger.info("Attempting to send message through Gmail API...")
         sent_message = service.users().messages().send(
             userId='me',
-            body=message_body
+            body=message_body,
+            fields='id'
         ).execute()
         
-        logger.info(f"Message sent successfully! Message ID: {sent_message['id']}")
+        logger.debug("Message sent, ID: %s", sent_message['id'])
         return True
             
     except Exception as e:
-        logger.error(f"Error in send_email: {str(e)}")
-        logger.error(f"Error type: {type(e)}")
-        logger.error(f"Error details: {e.__dict__}")
+        logger.error("Error in send_email (%s): %s", type(e).__name__, e)
         raise e
 
 def analyze_conversation_content(messages):
     """Analyzes conversation content for key points and action items"""
     try:
+        cache_key = "analysis:" + hashlib.blake2b(orjson.dumps(messages), digest_size=16).hexdigest()
+        if redis_client is not None:
+            try:
+                cached = redis_client.get(cache_key)
+            except redis.RedisError as e:
+                logger.warning("Analysis cache read failed: %s", e)
+                cached = None
+            if cached is not None:
+                return cached.decode()
+
         analysis_prompt = f"""
         Analyze this conversation and extract:
         1. Key discussion points
@@ -360,19 +626,37 @@ def analyze_conversation_content(messages):
         {messages}
         """
         
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = create_chat_completion(
+            model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are an AI analyzing conversations for important information and tasks."},
                 {"role": "user", "content": analysis_prompt}
-            ]
+            ],
+            max_tokens=256,
+            temperature=0
         )
         
-        return response.choices[0].message.content
+        analysis = response.choices[0].message.content
+        if redis_client is not None:
+            try:
+                redis_client.set(cache_key, analysis, ex=ANALYSIS_CACHE_TTL)
+            except redis.RedisError as e:
+                logger.warning("Analysis cache write failed: %s", e)
+        return analysis
     except Exception as e:
-        logger.error(f"Error analyzing conversation: {str(e)}")
+        logger.error("Error analyzing conversation: %s", e)
         return None
 
+def store_conversation_analysis(conversation_id, messages):
+    """Analyzes the conversation and stores the result for suggesting actions"""
+    analysis = analyze_conversation_content(messages)
+    if analysis:
+        db.collection('conversation_analyses').add({
+            'conversation_id': conversation_id,
+            'analysis': analysis,
+            'timestamp': firestore.SERVER_TIMESTAMP
+        })
+
 def compose_intelligent_email(context, recipient, subject, tone="professional"):
     """Composes an email based on context and parameters"""
     try:
@@ -387,7 +671,7 @@ def compose_intelligent_email(context, recipient, subject, tone="professional"):
         Include a clear subject line and appropriate greeting/closing.
         """
         
-        response = client.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "You are an expert email composer."},
@@ -397,9 +681,60 @@ def compose_intelligent_email(context, recipient, subject, tone="professional"):
         
         return response.choices[0].message.content
     except Exception as e:
-        logger.error(f"Error composing email: {str(e)}")
+        logger.error("Error composing email: %s", e)
         return None
 
+def stream_chat_reply(conversation_id, conversation, messages):
+    """Streams the assistant reply as server-sent events and saves the conversation once complete"""
+    stream = create_chat_completion(model="gpt-4", messages=messages, stream=True)
+
+    def generate():
+        chunks = []
+        yield from sse_deltas(stream, chunks)
+        conversation.append({"role": "assistant", "content": "".join(chunks)})
+        save_conversation(conversation_id, conversation)
+        yield sse_event({"done": True, "conversation_id": conversation_id})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
+def handle_compose_email_intent(user_message):
+    """Drafts the email the user asked for and offers to send it"""
+    # Extract email details from the message using GPT
+    email_analysis = create_chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "Extract email details from the user's request."},
+            {"role": "user", "content": user_message}
+        ],
+        max_tokens=256,
+        temperature=0
+    )
+
+    email_details = email_analysis.choices[0].message.content
+    composed_email = compose_intelligent_email(
+        context=email_details,
+        recipient="extracted_recipient@example.com",  # Extract from analysis
+        subject="Extracted Subject",  # Extract from analysis
+        tone="professional"
+    )
+
+    return f"I've composed this email for you:\n\n{composed_email}\n\nWould you like me to send it?"
+
+def handle_calendar_intent(user_message):
+    # Process calendar request...
+    return "I'll help you schedule that. Let me check your calendar..."
+
+# In priority order: a message that asks for both is treated as the earlier intent here
+CHAT_INTENT_HANDLERS = {
+    "compose_email": handle_compose_email_intent,
+    "calendar": handle_calendar_intent,
+}
+
+def classify_intent(message):
+    """Highest-priority intent named anywhere in message, or None"""
+    found = {match.lastgroup for match in INTENT_RE.finditer(message)}
+    return next((intent for intent in CHAT_INTENT_HANDLERS if intent in found), None)
+
 @app.route('/chat', methods=['POST'])
 def chat():
     try:
@@ -408,117 +743,89 @@ def chat():
         conversation_id = data.get('conversation_id')
         user_id = data.get('user_id')
 
+        if not conversation_id:
+            return ojsonify({"error": "conversation_id is required"}), 400
+        if not is_valid_conversation_id(conversation_id):
+            return ojsonify({"error": "Invalid conversation_id"}), 400
+
         # Load conversation history
-        conversation_history = load_conversation_history()
-        current_conversation = conversation_history.get(conversation_id, [])
+        current_conversation = load_conversation(conversation_id)
         
         # Add user message to history
         current_conversation.append({"role": "user", "content": user_message})
         
-        # Check for email-related commands
-        if "compose email" in user_message.lower():
-            # Extract email details from the message using GPT
-            email_analysis = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "Extract email details from the user's request."},
-                    {"role": "user", "content": user_message}
-                ]
-            )
-            
-            email_details = email_analysis.choices[0].message.content
-            composed_email = compose_intelligent_email(
-                context=email_details,
-                recipient="extracted_recipient@example.com",  # Extract from analysis
-                subject="Extracted Subject",  # Extract from analysis
-                tone="professional"
-            )
-            
-            response_content = f"I've composed this email for you:\n\n{composed_email}\n\nWould you like me to send it?"
-        
-        # Check for calendar-related commands
-        elif any(keyword in user_message.lower() for keyword in ["schedule", "appointment", "meeting", "event"]):
-            # Use existing calendar integration
-            service = get_calendar_service(user_id)
-            # Process calendar request...
-            response_content = "I'll help you schedule that. Let me check your calendar..."
-        
+        # Route email/calendar commands to their handler
+        intent = classify_intent(user_message)
+        if intent:
+            response_content = CHAT_INTENT_HANDLERS[intent](user_message)
         else:
             # Regular chat interaction
-            messages = [{"role": "system", "content": system_prompt}]
-            messages.extend(current_conversation)
+            # Analyze conversation for action items alongside the reply; the response doesn't wait for it.
+            # Only analyze if there's enough context and the new message adds something
+            if len(current_conversation) > 2 and len(user_message.strip()) > ANALYSIS_MIN_MESSAGE_LENGTH:
+                run_in_background(store_conversation_analysis, conversation_id,
+                                  [msg["content"] for msg in current_conversation])
+
+            messages = [SYSTEM_MESSAGE, *current_conversation]
+
+            if data.get('stream'):
+                return stream_chat_reply(conversation_id, current_conversation, messages)
             
-            response = client.chat.completions.create(
+            response = create_chat_completion(
                 model="gpt-4",
                 messages=messages
             )
             
             response_content = response.choices[0].message.content
-            
-            # Analyze conversation for action items
-            if len(current_conversation) > 2:  # Only analyze if there's enough context
-                analysis = analyze_conversation_content([msg["content"] for msg in current_conversation])
-                if analysis:
-                    # Store analysis in database or use it to suggest actions
-                    db.collection('conversation_analyses').add({
-                        'conversation_id': conversation_id,
-                        'analysis': analysis,
-                        'timestamp': datetime.now().isoformat()
-                    })
 
         # Add assistant response to history
         current_conversation.append({"role": "assistant", "content": response_content})
-        conversation_history[conversation_id] = current_conversation
-        save_conversation_history(conversation_history)
+        save_conversation(conversation_id, current_conversation)
 
-        return jsonify({
+        return ojsonify({
             "response": response_content,
             "conversation_id": conversation_id
         })
 
     except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error in chat endpoint: %s", e)
+        return ojsonify({"error": str(e)}), 500
 
 # Add a new endpoint to get conversation history
 @app.route('/chat/history/<conversation_id>', methods=['GET'])
 def get_chat_history(conversation_id):
+    if not is_valid_conversation_id(conversation_id):
+        return ojsonify({"error": "Invalid conversation_id"}), 400
     try:
-        conversation_history = load_conversation_history()
-        history = conversation_history.get(conversation_id, [])
-        return jsonify({"history": history})
+        history = load_conversation(conversation_id)
+        return ojsonify({"history": history})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}), 500
 
 # Add an endpoint to clear conversation history
 @app.route('/chat/history/<conversation_id>', methods=['DELETE'])
 def clear_chat_history(conversation_id):
+    if not is_valid_conversation_id(conversation_id):
+        return ojsonify({"error": "Invalid conversation_id"}), 400
     try:
-        conversation_history = load_conversation_history()
-        if conversation_id in conversation_history:
-            del conversation_history[conversation_id]
-            save_conversation_history(conversation_history)
-        return jsonify({"message": "Conversation history cleared"})
+        delete_conversation(conversation_id)
+        return ojsonify({"message": "Conversation history cleared"})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}), 500
+
+def list_collection(name):
+    """Fetches every document in a Firestore collection in one call, with its id merged in"""
+    return [{**doc.to_dict(), 'id': doc.id} for doc in db.collection(name).get()]
 
 @app.route('/todos', methods=['GET', 'POST'])
 def todos():
     if request.method == 'GET':
         try:
-            todos_ref = db.collection('todolist')
-            todos = []
-            for doc in todos_ref.stream():
-                data = doc.to_dict()
-                data['id'] = doc.id
-                data['name'] = doc.id
-                print(f"Retrieved todo list: {data}")
-                todos.append(data)
-            print(f"Total todo lists found: {len(todos)}")
-            return jsonify(todos)
+            todos = [{**todo, 'name': todo['id']} for todo in list_collection('todolist')]
+            return ojsonify(todos)
         except Exception as e:
-            print(f"Error fetching todos: {str(e)}")
-            return jsonify({"error": str(e)}), 500
+            logger.error("Error fetching todos: %s", e)
+            return ojsonify({"error": str(e)}), 500
     
     elif request.method == 'POST':
         try:
@@ -527,7 +834,7 @@ def todos():
             tasks = data.get('tasks', [])
             
             if not list_name:
-                return jsonify({"error": "List name is required"}), 400
+                return ojsonify({"error": "List name is required"}), 400
             
             # Create a new document in the todolist collection
             doc_ref = db.collection('todolist').document(list_name)
@@ -541,10 +848,10 @@ def todos():
                     'category': task.get('category', 'general'),
                     'completed': False
                 } for task in tasks],
-                'created_at': datetime.now()
+                'created_at': firestore.SERVER_TIMESTAMP
             })
             
-            return jsonify({
+            return ojsonify({
                 "message": "Todo list created successfully",
                 "id": list_name,
                 "name": list_name,
@@ -552,88 +859,95 @@ def todos():
             })
             
         except Exception as e:
-            print(f"Error creating todo: {str(e)}")
-            return jsonify({"error": str(e)}), 500
+            logger.error("Error creating todo: %s", e)
+            return ojsonify({"error": str(e)}), 500
 
 @app.route('/events', methods=['GET'])
 def get_events():
     try:
-        events_ref = db.collection('events')
-        events = []
-        for doc in events_ref.stream():
-            data = doc.to_dict()
-            data['id'] = doc.id
-            print(f"Retrieved event: {data}")
-            events.append(data)
-        print(f"Total events found: {len(events)}")
-        return jsonify(events)
+        return ojsonify(list_collection('events'))
     except Exception as e:
-        print(f"Error fetching events: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error fetching events: %s", e)
+        return ojsonify({"error": str(e)}), 500
 
 @app.route('/assignments', methods=['GET'])
 def get_assignments():
     try:
-        assignments_ref = db.collection('assignments')
-        assignments = []
-        for doc in assignments_ref.stream():
-            data = doc.to_dict()
-            data['id'] = doc.id
-            print(f"Retrieved assignment: {data}")
-            assignments.append(data)
-        print(f"Total assignments found: {len(assignments)}")
-        return jsonify(assignments)
+        return ojsonify(list_collection('assignments'))
     except Exception as e:
-        print(f"Error fetching assignments: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error fetching assignments: %s", e)
+        return ojsonify({"error": str(e)}), 500
 
 @app.route('/exams', methods=['GET'])
 def get_exams():
     try:
-        exams_ref = db.collection('exams')
-        exams = []
-        for doc in exams_ref.stream():
-            data = doc.to_dict()
-            data['id'] = doc.id
-            print(f"Retrieved exam: {data}")
-            exams.append(data)
-        print(f"Total exams found: {len(exams)}")
-        return jsonify(exams)
+        return ojsonify(list_collection('exams'))
     except Exception as e:
-        print(f"Error fetching exams: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error fetching exams: %s", e)
+        return ojsonify({"error": str(e)}), 500
+
+def event_body_from_request(details):
+    """Builds a Calendar event resource from a /calendar/create-event payload"""
+    return {
+        'summary': details.get('summary'),
+        'description': details.get('description'),
+        'start': {
+            'dateTime': details.get('start_time'),
+            'timeZone': details.get('timezone', 'UTC'),
+        },
+        'end': {
+            'dateTime': details.get('end_time'),
+            'timeZone': details.get('timezone', 'UTC'),
+        },
+    }
 
 # Add a new route for creating calendar events
 @app.route('/calendar/create-event', methods=['POST'])
 def create_calendar_event():
     try:
         data = request.json
-        service = get_calendar_service()
-        
-        event = {
-            'summary': data.get('summary'),
-            'description': data.get('description'),
-            'start': {
-                'dateTime': data.get('start_time'),
-                'timeZone': data.get('timezone', 'UTC'),
-            },
-            'end': {
-                'dateTime': data.get('end_time'),
-                'timeZone': data.get('timezone', 'UTC'),
-            },
-        }
+        user_id = data.get('user_id')
+        events_details = data.get('events', [data])
+        if not events_details or not isinstance(events_details, list) or not all(isinstance(details, dict) for details in events_details):
+            return ojsonify({"error": "events must be a non-empty list of objects"}), 400
 
-        event = service.events().insert(calendarId='primary', body=event).execute()
-        return jsonify({"message": "Event created successfully", "event": event})
+        service = get_calendar_service(user_id)
+        event_bodies = [event_body_from_request(details) for details in events_details]
+
+        if len(event_bodies) == 1:
+            event = service.events().insert(calendarId='primary', body=event_bodies[0], fields=EVENT_INSERT_FIELDS).execute()
+            invalidate_upcoming_events(user_id)
+            return ojsonify({"message": "Event created successfully", "event": event})
+
+        # Several events go out as batch requests instead of one round trip each
+        events = [None] * len(event_bodies)
+
+        def collect(request_id, response, exception):
+            events[int(request_id)] = {"error": str(exception)} if exception else response
+
+        for start in range(0, len(event_bodies), CALENDAR_BATCH_LIMIT):
+            batch = service.new_batch_http_request(callback=collect)
+            for index in range(start, min(start + CALENDAR_BATCH_LIMIT, len(event_bodies))):
+                batch.add(service.events().insert(calendarId='primary', body=event_bodies[index],
+                                                  fields=EVENT_INSERT_FIELDS),
+                          request_id=str(index))
+            batch.execute()
+        invalidate_upcoming_events(user_id)
+        failed = sum(1 for event in events if "error" in event)
+        if failed == len(events):
+            return ojsonify({"error": "No events were created", "failed": failed, "events": events}), 502
+        if failed:
+            return ojsonify({"message": "Some events were not created", "failed": failed, "events": events}), 207
+        return ojsonify({"message": "Events created", "failed": 0, "events": events})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}), 500
 
 # Add these new routes before the main run block
 @app.route('/auth/google/login', methods=['GET'])
 def google_login():
     try:
-        flow = Flow.from_client_secrets_file(
-            CLIENT_SECRETS_FILE,
+        flow = Flow.from_client_config(
+            load_client_secrets(),
             scopes=SCOPES,
             redirect_uri=ALLOWED_REDIRECT_URIS[0]  # Use Supabase callback
         )
@@ -648,13 +962,13 @@ def google_login():
         # Store the state
         session['state'] = state
         
-        return jsonify({
+        return ojsonify({
             'authorization_url': authorization_url,
             'state': state
         })
     except Exception as e:
-        logger.error(f"Error in Google login: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        logger.error("Error in Google login: %s", e)
+        return ojsonify({'error': str(e)}), 500
 
 @app.route('/auth/google/callback', methods=['GET'])
 def google_callback():
@@ -663,10 +977,10 @@ def google_callback():
         code = request.args.get('code')
         
         if not state or not code:
-            return jsonify({'error': 'Missing state or code'}), 400
+            return ojsonify({'error': 'Missing state or code'}), 400
             
-        flow = Flow.from_client_secrets_file(
-            CLIENT_SECRETS_FILE,
+        flow = Flow.from_client_config(
+            load_client_secrets(),
             scopes=SCOPES,
             state=state,
             redirect_uri=ALLOWED_REDIRECT_URIS[0]
@@ -679,50 +993,58 @@ def google_callback():
         # Store credentials
         user_id = request.args.get('user_id', 'default_user')
         user_credentials[user_id] = credentials
+        invalidate_google_services(user_id)
         
         # Redirect to frontend with success
         return redirect(f"{ALLOWED_REDIRECT_URIS[1]}?success=true")
     except Exception as e:
-        logger.error(f"Error in Google callback: {str(e)}")
+        logger.error("Error in Google callback: %s", e)
         return redirect(f"{ALLOWED_REDIRECT_URIS[1]}?error={str(e)}")
 
 @app.route('/calendar/events')
 def list_calendar_events():
     try:
-        credentials = None
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
-                credentials = pickle.load(token)
-                
+        page_token = request.args.get('page_token')
+        try:
+            max_results = int(request.args.get('max_results', 10))
+        except ValueError:
+            max_results = 0
+        if not 1 <= max_results <= CALENDAR_MAX_RESULTS:
+            return ojsonify({"error": f"max_results must be an integer from 1 to {CALENDAR_MAX_RESULTS}"}), 400
+
+        credentials = load_local_credentials()
+
         if not credentials or not credentials.valid:
             if credentials and credentials.expired and credentials.refresh_token:
                 credentials.refresh(Request())
             else:
-                return jsonify({"error": "No valid credentials"}), 401
+                return ojsonify({"error": "No valid credentials"}), 401
+
+        service = get_local_calendar_service()
 
-        service = build('calendar', 'v3', credentials=credentials)
-        
         # Call the Calendar API
-        now = datetime.now(datetime.UTC).isoformat() + 'Z'  # 'Z' indicates UTC time
         events_result = service.events().list(
             calendarId='primary',
-            timeMin=now,
-            maxResults=10,
+            timeMin=utc_now_rfc3339(),
+            maxResults=max_results,
+            pageToken=page_token,
             singleEvents=True,
-            orderBy='startTime'
+            orderBy='startTime',
+            fields=EVENT_LIST_FIELDS
         ).execute()
-        events = events_result.get('items', [])
-        
-        return jsonify(events)
+
+        return ojsonify({
+            "items": events_result.get('items', []),
+            "nextPageToken": events_result.get('nextPageToken')
+        })
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}), 500
 
 # Update the calendar event creation function
 def create_calendar_event(service, event_details):
     """Create a calendar event using the Google Calendar API."""
     try:
-        logger.info("=== Creating Calendar Event ===")
-        logger.info(f"Event details received: {event_details}")
+        logger.debug("Creating calendar event from details: %s", event_details)
         
         # Extract event details
         summary = event_details.get('summary', 'Untitled Event')
@@ -734,14 +1056,6 @@ def create_calendar_event(service, event_details):
         recurrence = event_details.get('recurrence')
         timezone = event_details.get('timezone', 'America/New_York')  # Default to NY timezone
         
-        logger.info(f"Extracted details - Summary: {summary}")
-        logger.info(f"Start time: {start_time}")
-        logger.info(f"End time: {end_time}")
-        logger.info(f"Location: {location}")
-        logger.info(f"Attendees: {attendees}")
-        logger.info(f"Recurrence: {recurrence}")
-        logger.info(f"Timezone: {timezone}")
-        
         # Create the event object with the times as provided
         event = {
             'summary': summary,
@@ -760,98 +1074,460 @@ def create_calendar_event(service, event_details):
         
         # Add recurrence if specified
         if recurrence:
-            logger.info("Adding recurrence rule")
             event['recurrence'] = [recurrence]
         
-        logger.info("Attempting to insert event into calendar...")
-        event = service.events().insert(calendarId='primary', body=event).execute()
-        logger.info(f"Event created successfully with ID: {event.get('id')}")
+        event = service.events().insert(calendarId='primary', body=event, fields=EVENT_INSERT_FIELDS).execute()
+        logger.debug("Event created with ID: %s", event.get('id'))
         return event
         
     except Exception as e:
-        logger.error(f"Error creating calendar event: {e}")
-        logger.error(f"Error type: {type(e)}")
-        logger.error(f"Error details: {e.__dict__}")
+        logger.error("Error creating calendar event (%s): %s", type(e).__name__, e)
         raise
 
+BATCH_INSTRUCTIONS = """
+
+You will receive several numbered tasks. Handle each one independently and respond with
+only a JSON array of strings, one element per task, in the same order as the tasks."""
+
+def tool_call_decision(tool_call):
+    """Serializes a tool call (or None) as an {"action", "fields"} decision string"""
+    if tool_call is None:
+        return orjson.dumps({"action": "none", "fields": {}}).decode()
+    try:
+        fields = orjson.loads(tool_call.function.arguments)
+    except orjson.JSONDecodeError:
+        return ""  # unparseable arguments; the caller escalates
+    return orjson.dumps({"action": tool_call.function.name, "fields": fields}).decode()
+
+class CompletionBatcher:
+    """Coalesces concurrent prompts that share a system prompt into one chat completion.
+
+    Prompts from the same group arriving within max_wait seconds of each other (up to
+    max_batch) are sent as a numbered list and the answers are split back out by index,
+    trading a few milliseconds of latency for far fewer requests against OpenAI's RPM
+    limit. Groups are never mixed: callers pass the user_id so one user's prompt (or an
+    injection in it) never shares a completion with another user's.
+    """
+
+    def __init__(self, system_prompt, model="gpt-4", max_batch=8, max_wait=0.05):
+        self.system_prompt = system_prompt
+        self.model = model
+        # Built once and shared by every request this batcher sends
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.batch_system_message = {"role": "system", "content": system_prompt + BATCH_INSTRUCTIONS}
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def submit(self, prompt, group):
+        """Blocks until the completion for prompt is available and returns its text"""
+        future = Future()
+        self.pending.put((group, prompt, future))
+        return future.result()
+
+    def _collect(self):
+        while True:
+            window = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(window) < 4 * self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    window.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            groups = {}
+            for group, prompt, future in window:
+                groups.setdefault(group, []).append((prompt, future))
+            # Complete off this thread so the next window keeps filling while GPT works
+            for items in groups.values():
+                for start in range(0, len(items), self.max_batch):
+                    io_pool.submit(self._complete, items[start:start + self.max_batch])
+
+    def _complete(self, batch):
+        if len(batch) == 1:
+            prompt, future = batch[0]
+            try:
+                response = create_chat_completion(
+                    model=self.model,
+                    messages=[self.system_message, {"role": "user", "content": prompt}]
+                )
+                future.set_result(response.choices[0].message.content)
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        numbered = "\n\n".join(f"Task {i + 1}:\n{prompt}" for i, (prompt, _) in enumerate(batch))
+        try:
+            response = create_chat_completion(
+                model=self.model,
+                messages=[self.batch_system_message, {"role": "user", "content": numbered}]
+            )
+            results = orjson.loads(response.choices[0].message.content)
+            if not isinstance(results, list) or len(results) != len(batch):
+                raise ValueError(f"expected {len(batch)} results, got {results!r:.200}")
+        except Exception as e:
+            # Fall back to one request per prompt rather than failing every waiter
+            logger.warning("Batched completion failed, retrying individually: %s", e)
+            for item in batch:
+                io_pool.submit(self._complete, [item])
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result if isinstance(result, str) else orjson.dumps(result).decode())
+
+# Email and calendar tasks only need a routing decision, so the model answers with a tool call
+SEND_EMAIL_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "send_email",
+        "description": "Send the email described by the task.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "recipient": {"type": "string"},
+                "subject": {"type": "string"},
+                "body": {"type": "string", "description": "Full email body to send"}
+            },
+            "required": ["body"]
+        }
+    }
+}
+CREATE_EVENT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "create_event",
+        "description": "Create the calendar event described by the task.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "summary": {"type": "string"},
+                "description": {"type": "string"},
+                "start_time": {"type": "string", "description": "YYYY-MM-DDTHH:MM:SS"},
+                "end_time": {"type": "string", "description": "YYYY-MM-DDTHH:MM:SS"},
+                "timezone": {"type": "string"},
+                "location": {"type": "string"},
+                "attendees": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["summary", "start_time", "end_time"]
+        }
+    }
+}
+AUTOMATION_ACTIONS = {"send_email", "create_event", "none"}
+
+def handle_email_task(decision, task_details, user_id, gmail_future):
+    """Sends the email when the model decided one is needed"""
+    if decision["action"] != "send_email":
+        return {"message": "No email action required"}, 200
+    fields = decision["fields"]
+    # Runs to completion, bounded by the socket timeout: abandoning it on a wait timeout could
+    # report failure for a mail that still goes out, and a client retry would send it twice
+    send_email(gmail_future.result(timeout=GOOGLE_CALL_TIMEOUT),
+               to=task_details.get('recipient') or fields.get('recipient'),
+               subject=task_details.get('subject') or fields.get('subject'),
+               body=fields.get('body') or task_details.get('body', ''))
+    return {"message": "Email sent successfully"}, 200
+
+def handle_calendar_task(decision, task_details, user_id, calendar_future):
+    """Creates the calendar event when the model decided one is needed"""
+    if decision["action"] != "create_event":
+        return {"message": "No calendar action required"}, 200
+    # Explicit task details win over the model's extracted arguments. Not abandoned on a
+    # timeout: that could report failure for an event that still gets created.
+    event = create_calendar_event(calendar_future.result(timeout=GOOGLE_CALL_TIMEOUT),
+                                  {**decision["fields"], **task_details})
+    invalidate_upcoming_events(user_id)
+    return {"message": "Calendar event created", "event_id": event.get('id')}, 200
+
+def handle_schedule_task(optimized_schedule, task_details, user_id, _):
+    """Returns the optimized schedule, storing it without holding up the response"""
+    run_in_background(db.collection('schedules').add, {
+        'user_id': user_id,
+        'schedule': optimized_schedule,
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    return {
+        "message": "Schedule optimized",
+        "schedule": optimized_schedule
+    }, 200
+
+class EmailTaskDetails(BaseModel):
+    """details payload for an email automation task"""
+    model_config = ConfigDict(extra='allow')
+
+    recipient: EmailStr
+    subject: str
+    body: Optional[str] = None
+
+class CalendarTaskDetails(BaseModel):
+    """details payload for a calendar automation task; the model fills in missing fields"""
+    model_config = ConfigDict(extra='allow')
+
+    summary: Optional[str] = None
+    description: Optional[str] = None
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    timezone: Optional[str] = None
+    location: Optional[str] = None
+    attendees: Optional[List[EmailStr]] = None
+
+@dataclass(frozen=True)
+class TaskConfig:
+    """How one /tasks/automate task type is prompted and acted on"""
+    system_prompt: str
+    user_template: str
+    handler: Callable  # (model output, task_details, user_id, service future) -> (payload, status)
+    tools: Optional[list] = None  # when set, the model output is a tool-call decision
+    service: Optional[Callable] = None  # Google client to build while GPT works
+    persist_cache: bool = True  # mirror cached decisions to Firestore
+    details_model: Optional[type] = None  # validates task details before any API call
+
+    @functools.cached_property
+    def system_message(self):
+        return {"role": "system", "content": self.system_prompt}
+
+TASK_CONFIGS = {
+    "email": TaskConfig(
+        system_prompt="You are an email automation assistant. Call send_email when the task requires sending an email.",
+        user_template="Process this email task: {}",
+        handler=handle_email_task,
+        tools=[SEND_EMAIL_TOOL],
+        service=get_gmail_service,
+        persist_cache=False,  # the decision carries the body of a sent email
+        details_model=EmailTaskDetails
+    ),
+    "calendar": TaskConfig(
+        system_prompt="You are a calendar management assistant. Call create_event when the task requires a new event.",
+        user_template="Process this calendar task: {}",
+        handler=handle_calendar_task,
+        tools=[CREATE_EVENT_TOOL],
+        service=get_calendar_service,
+        details_model=CalendarTaskDetails
+    ),
+    "schedule": TaskConfig(
+        system_prompt="You are a schedule management assistant.",
+        user_template="Optimize this schedule: {}",
+        handler=handle_schedule_task
+    ),
+}
+
+# One batcher per content task type so each batch shares a coherent system prompt.
+# Tool-calling types act on their decision (send, create), so they are never batched.
+automation_batchers = {
+    task_type: CompletionBatcher(config.system_prompt, model="gpt-4o-mini")
+    for task_type, config in TASK_CONFIGS.items()
+    if not config.tools
+}
+
+LLM_CACHE_TTL = 7 * 24 * 3600  # seconds; give llm_cache a Firestore TTL policy on expires_at
+
+class CompletionCache:
+    """Completion cache keyed on the exact prompt text within a namespace.
+
+    Entries live in an in-process LRU until they expire after ttl seconds and, unless
+    persist=False, are mirrored to the Firestore llm_cache collection so new workers
+    start warm. Only exact repeats match: prompts that differ in a date or time must
+    never share a completion.
+    """
+
+    def __init__(self, max_entries=5000, ttl=LLM_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (namespace, prompt) -> (completion, expiry timestamp)
+        self.entries = cachetools.TLRUCache(maxsize=max_entries, ttu=lambda _key, entry, _now: entry[1],
+                                            timer=time.time)
+        self.lock = threading.Lock()
+
+    def get_or_create(self, namespace, prompt, create, persist=True):
+        """Returns a cached completion for prompt, calling create() on a miss; None is not cached"""
+        with self.lock:
+            cached = self.entries.get((namespace, prompt))
+        if cached is not None:
+            return cached[0]
+
+        completion = create()
+        if completion is None:
+            return None
+        with self.lock:
+            self.entries[(namespace, prompt)] = (completion, time.time() + self.ttl)
+        if persist:
+            run_in_background(db.collection('llm_cache').add, {
+                'namespace': namespace,
+                'prompt': prompt,
+                'completion': completion,
+                'created_at': firestore.SERVER_TIMESTAMP,
+                'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+            })
+        return completion
+
+    def load(self):
+        """Warms the cache from the most recent Firestore entries"""
+        try:
+            docs = (db.collection('llm_cache')
+                    .order_by('created_at', direction=firestore.Query.DESCENDING)
+                    .limit(self.max_entries)
+                    .stream())
+            now = time.time()
+            loaded = []
+            for doc in reversed(list(docs)):
+                entry = doc.to_dict()
+                # Entries written before expiry was tracked are treated as expired
+                expires_at = entry.get('expires_at')
+                if expires_at is None or expires_at.timestamp() <= now:
+                    continue
+                loaded.append(((entry['namespace'], entry['prompt']), (entry['completion'], expires_at.timestamp())))
+            with self.lock:
+                # Entries added since startup are newer than anything loaded, so they win
+                for key, value in loaded:
+                    if key not in self.entries:
+                        self.entries[key] = value
+        except Exception as e:
+            logger.warning("Could not load LLM cache from Firestore: %s", e)
+
+llm_cache = CompletionCache()
+threading.Thread(target=llm_cache.load, daemon=True).start()
+
+def parse_automation_decision(text):
+    """Parses an {"action", "fields"} decision; returns None if malformed or unknown"""
+    try:
+        decision = orjson.loads(text)
+    except (TypeError, orjson.JSONDecodeError):
+        return None
+    if not isinstance(decision, dict) or decision.get("action") not in AUTOMATION_ACTIONS:
+        return None
+    decision.setdefault("fields", {})
+    return decision
+
+def request_tool_decision(config, prompt, model):
+    """Asks model for a tool-call decision on prompt; returns the serialized decision"""
+    response = create_chat_completion(
+        model=model,
+        messages=[config.system_message, {"role": "user", "content": prompt}],
+        tools=config.tools,
+        tool_choice="auto"
+    )
+    message = response.choices[0].message
+    return tool_call_decision(message.tool_calls[0] if message.tool_calls else None)
+
+def decide_automation_action(task_type, prompt, namespace, persist=True):
+    """Gets a tool-call decision from gpt-4o-mini, escalating to gpt-4 when it is unusable"""
+    config = TASK_CONFIGS[task_type]
+
+    def decide():
+        # Only a usable decision is returned, so only a usable decision is cached
+        text = request_tool_decision(config, prompt, "gpt-4o-mini")
+        if parse_automation_decision(text) is None:
+            logger.info("Escalating %s task to gpt-4", task_type)
+            text = request_tool_decision(config, prompt, "gpt-4")
+        return text if parse_automation_decision(text) is not None else None
+
+    decision = parse_automation_decision(llm_cache.get_or_create(namespace, prompt, decide, persist=persist))
+    return decision or {"action": "none", "fields": {}}
+
+def run_automation_task(task_type, task_details, user_id):
+    """Processes a single automation task; returns (response payload, status code)"""
+    if not all([task_type, task_details]):
+        return {"error": "Missing required fields"}, 400
+
+    config = TASK_CONFIGS.get(task_type)
+    if config is None:
+        return {"error": "Invalid task type"}, 400
+
+    # Reject malformed details before paying for a GPT call
+    if config.details_model is not None:
+        try:
+            task_details = config.details_model.model_validate(task_details).model_dump(exclude_none=True)
+        except ValidationError as e:
+            return {"error": "Invalid task details", "details": e.errors(include_url=False, include_context=False)}, 400
+
+    # Build the Google client while GPT works on the task
+    service_future = io_pool.submit(config.service, user_id) if config.service else None
+    prompt = config.user_template.format(task_details)
+    # Cached completions are per user: the same prompt never returns another user's output
+    namespace = f"{task_type}:{user_id}"
+    if config.tools:
+        output = decide_automation_action(task_type, prompt, namespace, persist=config.persist_cache)
+    else:
+        output = llm_cache.get_or_create(
+            namespace, prompt, lambda: automation_batchers[task_type].submit(prompt, user_id),
+            persist=config.persist_cache
+        )
+    return config.handler(output, task_details, user_id, service_future)
+
+def stream_schedule_optimization(task_details, user_id):
+    """Streams the optimized schedule as server-sent events and saves it once complete"""
+    stream = create_chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            TASK_CONFIGS["schedule"].system_message,
+            {"role": "user", "content": TASK_CONFIGS["schedule"].user_template.format(task_details)}
+        ],
+        stream=True
+    )
+
+    def generate():
+        chunks = []
+        yield from sse_deltas(stream, chunks)
+        run_in_background(db.collection('schedules').add, {
+            'user_id': user_id,
+            'schedule': "".join(chunks),
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        yield sse_event({"message": "Schedule optimized", "done": True})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
 @app.route('/tasks/automate', methods=['POST'])
 def automate_task():
-    """Endpoint to handle automated task processing"""
+    """Endpoint to handle automated task processing.
+
+    Accepts a single task ({"type", "details", "user_id"}) or a batch
+    ({"user_id", "tasks": [{"type", "details"}, ...]}); batched tasks run concurrently.
+    A single schedule task with "stream": true is answered as server-sent events.
+    """
+    data = {}
     try:
         data = request.json
-        task_type = data.get('type')
-        task_details = data.get('details')
         user_id = data.get('user_id')
+        tasks = data.get('tasks')
 
-        if not all([task_type, task_details, user_id]):
-            return jsonify({"error": "Missing required fields"}), 400
+        if not user_id:
+            return ojsonify({"error": "Missing required fields"}), 400
 
-        if task_type == "email":
-            # Handle email automation
-            gmail_service = get_gmail_service(user_id)
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are an email automation assistant."},
-                    {"role": "user", "content": f"Process this email task: {task_details}"}
-                ]
-            )
-            processed_task = response.choices[0].message.content
-            
-            # Send email if required
-            if "send_email" in processed_task.lower():
-                send_email(gmail_service, 
-                         to=task_details.get('recipient'),
-                         subject=task_details.get('subject'),
-                         body=processed_task)
-                return jsonify({"message": "Email sent successfully"})
-
-        elif task_type == "calendar":
-            # Handle calendar automation
-            calendar_service = get_calendar_service(user_id)
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a calendar management assistant."},
-                    {"role": "user", "content": f"Process this calendar task: {task_details}"}
-                ]
-            )
-            processed_task = response.choices[0].message.content
-            
-            # Create calendar event if required
-            if "create_event" in processed_task.lower():
-                event = create_calendar_event(calendar_service, task_details)
-                return jsonify({"message": "Calendar event created", "event_id": event.get('id')})
-
-        elif task_type == "schedule":
-            # Handle schedule management
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a schedule management assistant."},
-                    {"role": "user", "content": f"Optimize this schedule: {task_details}"}
-                ]
-            )
-            optimized_schedule = response.choices[0].message.content
-            
-            # Store optimized schedule in database
-            db.collection('schedules').add({
-                'user_id': user_id,
-                'schedule': optimized_schedule,
-                'created_at': datetime.now().isoformat()
-            })
-            
-            return jsonify({
-                "message": "Schedule optimized",
-                "schedule": optimized_schedule
-            })
+        if tasks is None:
+            if data.get('type') == 'schedule' and data.get('stream') and data.get('details'):
+                return stream_schedule_optimization(data['details'], user_id)
+            payload, status = run_automation_task(data.get('type'), data.get('details'), user_id)
+            return ojsonify(payload), status
+
+        if not isinstance(tasks, list) or not tasks or not all(isinstance(task, dict) for task in tasks):
+            return ojsonify({"error": "tasks must be a non-empty list of objects"}), 400
+        if len(tasks) > MAX_AUTOMATION_TASKS:
+            return ojsonify({"error": f"At most {MAX_AUTOMATION_TASKS} tasks per request"}), 400
+
+        futures = [
+            automation_pool.submit(run_automation_task, task.get('type'), task.get('details'), user_id)
+            for task in tasks
+        ]
+        results = []
+        for task, future in zip(tasks, futures):
+            try:
+                payload, status = future.result()
+            except Exception as e:
+                logger.error("task automation failed", exc_info=True,
+                             extra={"task_type": task.get('type'), "user_id": user_id})
+                payload, status = {"error": str(e)}, 500
+            results.append({**payload, "status": status})
 
-        return jsonify({"error": "Invalid task type"}), 400
+        return ojsonify({"results": results})
 
     except Exception as e:
-        logger.error(f"Error in task automation: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("task automation failed", exc_info=True,
+                     extra={"task_type": data.get('type'), "user_id": data.get('user_id')})
+        return ojsonify({"error": str(e)}), 500
 
-# Run the application
+# Local development only; production runs under gunicorn's gevent workers (see Procfile)
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5500, debug=True) 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5500, debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
@@ -0,0 +1,17 @@
+"""One-off conversion of a pickled Google token into the token.json that /calendar/events reads.
+
+Usage: python convert_token.py [token.pickle] [token.json]
+"""
+import pickle
+import sys
+
+def convert(source="token.pickle", destination="token.json"):
+    # Only unpickle a token file you created yourself; pickle can run arbitrary code
+    with open(source, 'rb') as token:
+        credentials = pickle.load(token)
+    with open(destination, 'w') as token:
+        token.write(credentials.to_json())
+    print(f"Wrote {destination}")
+
+if __name__ == '__main__':
+    convert(*sys.argv[1:3])
@@ -0,0 +1,29 @@
+"""One-off import of conversation_history.json into the Firestore conversations collection.
+
+Conversations that already have a Firestore document are left alone, so re-running is safe.
+Usage: python migrate_conversations.py [conversation_history.json]
+"""
+import sys
+
+import orjson
+
+from app import CONVERSATIONS_COLLECTION, db, is_valid_conversation_id, save_conversation
+
+def migrate(path="conversation_history.json"):
+    with open(path, 'rb') as f:
+        history = orjson.loads(f.read())
+
+    imported = skipped = 0
+    for conversation_id, messages in history.items():
+        if not is_valid_conversation_id(conversation_id):
+            print(f"Skipping {conversation_id!r}: not a valid Firestore document id")
+            skipped += 1
+        elif db.collection(CONVERSATIONS_COLLECTION).document(conversation_id).get().exists:
+            skipped += 1
+        else:
+            save_conversation(conversation_id, messages)
+            imported += 1
+    print(f"Imported {imported} conversations, skipped {skipped}")
+
+if __name__ == '__main__':
+    migrate(*sys.argv[1:2])